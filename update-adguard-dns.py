@@ -5,15 +5,28 @@ Sets HOSTNAMES to point to the local ethernet IP
 Supports single hostname or multiple hostnames (comma-separated)
 """
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import re
 import subprocess
 import sys
+import tempfile
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 import logging
 from dotenv import load_dotenv
 import socket
+import struct
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -28,6 +41,41 @@ HOSTNAMES = os.getenv("HOSTNAMES")
 ADGUARD_USERNAME = os.getenv("ADGUARD_USERNAME")
 ADGUARD_PASSWORD = os.getenv("ADGUARD_PASSWORD")
 
+# AdGuard API base URL and shared session (reuses TCP connections across calls)
+ADGUARD_PROTOCOL = "https" if ADGUARD_USE_HTTPS else "http"
+BASE_URL = f"{ADGUARD_PROTOCOL}://{ADGUARD_HOST}:{ADGUARD_PORT}/control/rewrite"
+
+# Local state from the last fully successful run, used to skip unchanged updates
+CACHE_FILE = os.path.expanduser("~/.cache/adguard-dns-rewrite.json")
+CACHE_TTL = 3600  # seconds
+
+# Upper bound on hostnames processed concurrently (also the connection pool size)
+MAX_WORKERS = 8
+
+# (connect, read) timeouts in seconds for AdGuard API calls
+API_TIMEOUT = (2, 5)
+# Up to 3 attempts on connect errors and 502/503/504; read errors are never retried,
+# since AdGuard may already have applied a POST whose response was lost
+API_RETRY = Retry(total=2, read=0, backoff_factor=0.1, status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET', 'POST']))
+
+# POST bodies are serialised compactly by _post rather than via requests' json=
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+SESSION = requests.Session()
+SESSION.auth = HTTPBasicAuth(ADGUARD_USERNAME, ADGUARD_PASSWORD)
+SESSION.mount(f"{ADGUARD_PROTOCOL}://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=API_RETRY))
+
+# SIOCGIFADDR ioctl request number (differs between Linux and BSD/macOS)
+SIOCGIFADDR = 0xc0206921 if sys.platform == 'darwin' else 0x8915
+ETHERNET_INTERFACE_PREFIXES = ('en', 'eth', 'eno', 'ens', 'enp')
+
+# A single DNS label: 1-63 alphanumerics/hyphens, not starting or ending with a hyphen
+_LABEL_RE = re.compile(r'(?!-)[A-Za-z0-9-]{1,63}(?<!-)')
+
+# Source and global-scope IPv4 addresses in `ip route get` / `ip addr show` output
+_SRC_RE = re.compile(rb'\bsrc\s+(\d+\.\d+\.\d+\.\d+)')
+_INET_RE = re.compile(rb'inet\s+(\d+\.\d+\.\d+\.\d+)/\d+\s+.*scope global')
+
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -35,9 +83,9 @@ logger = logging.getLogger(__name__)
 def parse_hostnames():
     """Parse hostnames from HOSTNAMES environment variable"""
     if HOSTNAMES:
-        # Parse comma-separated list of hostnames
-        hostnames = [hostname.strip() for hostname in HOSTNAMES.split(',') if hostname.strip()]
-        logger.info(f"Using HOSTNAMES configuration: {hostnames}")
+        # Parse comma-separated list of hostnames, dropping duplicates but keeping order
+        hostnames = list(dict.fromkeys(hostname.strip() for hostname in HOSTNAMES.split(',') if hostname.strip()))
+        logger.info("Using HOSTNAMES configuration: %s", hostnames)
         return hostnames
     else:
         logger.error("No hostnames configured. Please set HOSTNAMES in your .env file.")
@@ -48,28 +96,14 @@ def validate_hostname(hostname):
     if not hostname or len(hostname) > 253:
         return False
     
-    # Check for valid characters and structure
     parts = hostname.split('.')
     if len(parts) < 2:  # Require at least domain.tld
         return False
     
-    # Check for suspicious patterns
-    if hostname.startswith('.') or hostname.endswith('.') or '..' in hostname:
-        return False
-    
-    # Validate each part
-    for part in parts:
-        if not part or len(part) > 63:
-            return False
-        # Must start and end with alphanumeric
-        if not part[0].isalnum() or not part[-1].isalnum():
-            return False
-        # Only allow alphanumeric and hyphens
-        if not all(c.isalnum() or c == '-' for c in part):
-            return False
-    
-    return True
+    # Validate each part (empty parts from leading/trailing/double dots fail the match)
+    return all(_LABEL_RE.fullmatch(part) for part in parts)
 
+@functools.lru_cache(maxsize=1)
 def is_running_in_docker():
     """Detect if running inside a Docker container."""
     # Check for the .dockerenv file
@@ -77,76 +111,119 @@ def is_running_in_docker():
         return True
     # Check cgroup for docker indication
     try:
-        with open('/proc/1/cgroup', 'rt') as f:
-            return 'docker' in f.read() or 'containerd' in f.read()
+        with open('/proc/1/cgroup', 'rb') as f:
+            data = f.read(4096)
+        return b'docker' in data or b'containerd' in data
     except Exception:
         return False
 
+@functools.lru_cache(maxsize=1)
 def get_docker_host_ip():
     """Get the Docker host IP address (host.docker.internal)."""
     try:
         # Try to resolve host.docker.internal
         ip = socket.gethostbyname('host.docker.internal')
-        logger.info(f"Detected Docker host IP: {ip}")
+        logger.info("Detected Docker host IP: %s", ip)
         return ip
     except Exception as e:
-        logger.error(f"Could not resolve host.docker.internal: {e}")
+        logger.error("Could not resolve host.docker.internal: %s", e)
         return None
 
+@functools.lru_cache(maxsize=1)
 def get_ethernet_ip():
     """Get the IP address of the ethernet interface or Docker host if in Docker."""
     if is_running_in_docker():
         logger.info("Running inside Docker. Using Docker host IP.")
         return get_docker_host_ip()
     
-    # Try platform-specific methods
-    ip = get_ip_linux() or get_ip_macos()
+    # Try in-process lookup first, then platform-specific methods
+    ip = get_ip_via_socket() or get_ip_via_ioctl() or get_ip_linux() or get_ip_macos()
     if ip:
         return ip
     
     logger.error("No ethernet IP address found on any platform")
     return None
 
+@functools.lru_cache(maxsize=1)
+def get_ip_via_socket():
+    """Get the outbound interface IP address using a UDP socket."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket sends no packets; it only selects a route
+        s.connect(('8.8.8.8', 80))
+        ip = s.getsockname()[0]
+        if not ip.startswith('127.') and not ip.startswith('169.254.'):
+            logger.info("Found IP using socket: %s", ip)
+            return ip
+        return None
+    except OSError as e:
+        logger.debug("Error getting IP via socket: %s", e)
+        return None
+    finally:
+        s.close()
+
+@functools.lru_cache(maxsize=1)
+def get_ip_via_ioctl():
+    """Get the ethernet interface IP address using the SIOCGIFADDR ioctl."""
+    if fcntl is None or not hasattr(fcntl, 'ioctl') or not hasattr(socket, 'if_nameindex'):
+        return None
+    
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            if not name.startswith(ETHERNET_INTERFACE_PREFIXES):
+                continue
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+            except OSError:
+                # Interface has no IPv4 address assigned
+                continue
+            # sockaddr_in follows the 16-byte interface name; the address is at offset 20
+            ip = socket.inet_ntoa(ifreq[20:24])
+            if not ip.startswith('127.') and not ip.startswith('169.254.'):
+                logger.info("Found ethernet IP: %s on interface %s", ip, name)
+                return ip
+        return None
+    except OSError as e:
+        logger.debug("Error getting IP via ioctl: %s", e)
+        return None
+    finally:
+        s.close()
+
+@functools.lru_cache(maxsize=1)
 def get_ip_linux():
     """Get IP address on Linux using ip command."""
     try:
         # Try using ip command (modern Linux)
-        result = subprocess.run(['ip', 'route', 'get', '8.8.8.8'], capture_output=True, text=True, check=True)
+        result = subprocess.run(['ip', 'route', 'get', '8.8.8.8'], capture_output=True, check=True)
         
-        # Parse output to find source IP
-        for line in result.stdout.split('\n'):
-            if 'src' in line:
-                parts = line.split()
-                src_index = parts.index('src')
-                if src_index + 1 < len(parts):
-                    ip = parts[src_index + 1]
-                    if not ip.startswith('127.') and not ip.startswith('169.254.'):
-                        logger.info(f"Found IP using ip command: {ip}")
-                        return ip
+        # Extract source IP from the route output
+        match = _SRC_RE.search(result.stdout)
+        if match:
+            ip = match.group(1).decode()
+            if not ip.startswith('127.') and not ip.startswith('169.254.'):
+                logger.info("Found IP using ip command: %s", ip)
+                return ip
         
         # Fallback: try ip addr show
-        result = subprocess.run(['ip', 'addr', 'show'], capture_output=True, text=True, check=True)
-        lines = result.stdout.split('\n')
+        result = subprocess.run(['ip', 'addr', 'show'], capture_output=True, check=True)
         
-        for line in lines:
-            line = line.strip()
-            if line.startswith('inet ') and 'scope global' in line:
-                parts = line.split()
-                if len(parts) >= 2:
-                    ip = parts[1].split('/')[0]  # Remove CIDR notation
-                    if not ip.startswith('127.') and not ip.startswith('169.254.'):
-                        logger.info(f"Found IP using ip addr: {ip}")
-                        return ip
+        for raw_ip in _INET_RE.findall(result.stdout):
+            ip = raw_ip.decode()
+            if not ip.startswith('127.') and not ip.startswith('169.254.'):
+                logger.info("Found IP using ip addr: %s", ip)
+                return ip
         
         return None
         
-    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+    except (subprocess.CalledProcessError, FileNotFoundError):
         logger.debug("ip command not available or failed")
         return None
     except Exception as e:
-        logger.debug(f"Error getting IP on Linux: {e}")
+        logger.debug("Error getting IP on Linux: %s", e)
         return None
 
+@functools.lru_cache(maxsize=1)
 def get_ip_macos():
     """Get IP address on macOS using ifconfig."""
     try:
@@ -162,7 +239,7 @@ def get_ip_macos():
             # New interface block
             if line.startswith('en'):
                 current_interface = line.split(':')[0]
-                logger.debug(f"Found interface: {current_interface}")
+                logger.debug("Found interface: %s", current_interface)
             
             # Look for inet address in ethernet interface
             elif line.startswith('inet ') and current_interface and current_interface.startswith('en'):
@@ -172,7 +249,7 @@ def get_ip_macos():
                     ip = parts[1]
                     # Skip loopback and link-local addresses
                     if not ip.startswith('127.') and not ip.startswith('169.254.'):
-                        logger.info(f"Found ethernet IP: {ip} on interface {current_interface}")
+                        logger.info("Found ethernet IP: %s on interface %s", ip, current_interface)
                         return ip
         
         return None
@@ -181,7 +258,7 @@ def get_ip_macos():
         logger.debug("ifconfig command not available or failed")
         return None
     except Exception as e:
-        logger.debug(f"Error getting IP on macOS: {e}")
+        logger.debug("Error getting IP on macOS: %s", e)
         return None
 
 def get_existing_rewrites():
@@ -191,31 +268,36 @@ def get_existing_rewrites():
         return None
     
     try:
-        protocol = "https" if ADGUARD_USE_HTTPS else "http"
-        url = f"{protocol}://{ADGUARD_HOST}:{ADGUARD_PORT}/control/rewrite/list"
-        response = requests.get(url, auth=HTTPBasicAuth(ADGUARD_USERNAME, ADGUARD_PASSWORD), timeout=10, verify=True)
+        url = f"{BASE_URL}/list"
+        response = SESSION.get(url, timeout=API_TIMEOUT, verify=True)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to get existing rewrites: {e}")
+        logger.error("Failed to get existing rewrites: %s", e)
         return None
 
-def delete_existing_rewrite(domain):
-    """Delete existing rewrite rule for the domain"""
+def _post(path, payload):
+    """POST a compact JSON payload to an AdGuard rewrite endpoint"""
+    response = SESSION.post(f"{BASE_URL}/{path}", data=json.dumps(payload, separators=(',', ':')), headers=JSON_HEADERS, timeout=API_TIMEOUT, verify=True)
+    response.raise_for_status()
+    return response
+
+def delete_existing_rewrite(domain, answer):
+    """Delete existing rewrite rule for the domain and answer"""
     if not ADGUARD_USERNAME or not ADGUARD_PASSWORD:
         logger.error("AdGuard credentials not configured")
         return False
     
     try:
-        protocol = "https" if ADGUARD_USE_HTTPS else "http"
-        url = f"{protocol}://{ADGUARD_HOST}:{ADGUARD_PORT}/control/rewrite/delete"
-        data = {"domain": domain}
-        response = requests.post(url, json=data, auth=HTTPBasicAuth(ADGUARD_USERNAME, ADGUARD_PASSWORD), timeout=10, verify=True)
-        response.raise_for_status()
-        logger.info(f"Deleted existing rewrite rule for {domain}")
+        data = {
+            "domain": domain,
+            "answer": answer
+        }
+        _post("delete", data)
+        logger.info("Deleted existing rewrite rule: %s -> %s", domain, answer)
         return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to delete existing rewrite: {e}")
+        logger.error("Failed to delete existing rewrite: %s", e)
         return False
 
 def validate_ip_address(ip):
@@ -236,57 +318,108 @@ def add_dns_rewrite(domain, ip):
     try:
         # Validate IP address
         if not validate_ip_address(ip):
-            logger.error(f"Invalid IP address format: {ip}")
+            logger.error("Invalid IP address format: %s", ip)
             return False
         
-        protocol = "https" if ADGUARD_USE_HTTPS else "http"
-        url = f"{protocol}://{ADGUARD_HOST}:{ADGUARD_PORT}/control/rewrite/add"
         data = {
             "domain": domain,
             "answer": ip
         }
         
-        response = requests.post(url, json=data, auth=HTTPBasicAuth(ADGUARD_USERNAME, ADGUARD_PASSWORD), timeout=10, verify=True)
-        response.raise_for_status()
-        logger.info(f"Successfully added DNS rewrite: {domain} -> {ip}")
+        _post("add", data)
+        logger.info("Successfully added DNS rewrite: %s -> %s", domain, ip)
         return True
         
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to add DNS rewrite: {e}")
+        logger.error("Failed to add DNS rewrite: %s", e)
         return False
 
-def process_hostname(hostname, local_ip, existing_rewrites):
+def cache_state(hostnames, local_ip):
+    """Build the state recorded in the cache file for a set of hostnames and IP"""
+    return {
+        "server": BASE_URL,
+        "hostnames": sorted(hostnames),
+        "ip": local_ip
+    }
+
+def is_cache_current(hostnames, local_ip):
+    """Check whether the last successful run applied the same state recently"""
+    try:
+        with open(CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug("No usable cache file: %s", e)
+        return False
+    
+    if not isinstance(cache, dict):
+        logger.debug("Ignoring malformed cache file %s", CACHE_FILE)
+        return False
+    
+    last_success_ts = cache.pop("last_success_ts", 0)
+    if not isinstance(last_success_ts, (int, float)):
+        logger.debug("Ignoring malformed cache file %s", CACHE_FILE)
+        return False
+    
+    # A timestamp in the future (clock stepped backwards) never counts as fresh
+    age = time.time() - last_success_ts
+    return cache == cache_state(hostnames, local_ip) and 0 <= age < CACHE_TTL
+
+def write_cache(hostnames, local_ip):
+    """Atomically record the state applied by a successful run"""
+    state = cache_state(hostnames, local_ip)
+    state["last_success_ts"] = time.time()
+    cache_dir = os.path.dirname(CACHE_FILE)
+    tmp_file = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Unique temp file per run so overlapping runs never share one
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+            tmp_file = f.name
+            json.dump(state, f)
+        os.replace(tmp_file, CACHE_FILE)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("Could not write cache file %s: %s", CACHE_FILE, e)
+        if tmp_file:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+def process_hostname(hostname, local_ip, existing):
     """Process a single hostname for DNS rewrite"""
-    logger.info(f"Processing hostname: {hostname}")
+    logger.info("Processing hostname: %s", hostname)
     
     # Validate hostname
     if not validate_hostname(hostname):
-        logger.error(f"Invalid hostname format: {hostname}")
+        logger.error("Invalid hostname format: %s", hostname)
         return False
     
-    # Check if rule already exists with same IP
-    for rewrite in existing_rewrites:
-        if rewrite.get('domain') == hostname:
-            if rewrite.get('answer') == local_ip:
-                logger.info(f"DNS rewrite already exists and is current: {hostname} -> {local_ip}")
-                return True
-            else:
-                logger.info(f"DNS rewrite exists but IP is different: {rewrite.get('answer')} -> {local_ip}")
-                # Delete existing rule
-                if not delete_existing_rewrite(hostname):
-                    logger.error(f"Failed to delete existing rewrite for {hostname}")
-                    return False
-                break
+    # Check if the only existing rule already points at the local IP
+    answers = existing.get(hostname, set())
+    if answers == {local_ip}:
+        logger.info("DNS rewrite already exists and is current: %s -> %s", hostname, local_ip)
+        return True
+    
+    # Delete every rule pointing elsewhere so clients only see the local IP
+    for answer in sorted(answers - {local_ip}, key=str):
+        logger.info("DNS rewrite exists but IP is different: %s -> %s", answer, local_ip)
+        if not delete_existing_rewrite(hostname, answer):
+            logger.error("Failed to delete existing rewrite for %s", hostname)
+            return False
+    
+    if local_ip in answers:
+        logger.info("DNS rewrite is now current: %s -> %s", hostname, local_ip)
+        return True
     
     # Add new rewrite rule
     if add_dns_rewrite(hostname, local_ip):
-        logger.info(f"Successfully added DNS rewrite: {hostname} -> {local_ip}")
+        logger.info("Successfully added DNS rewrite: %s -> %s", hostname, local_ip)
         return True
     else:
-        logger.error(f"Failed to add DNS rewrite for {hostname}")
+        logger.error("Failed to add DNS rewrite for %s", hostname)
         return False
 
-def update_dns_rewrite():
+def update_dns_rewrite(hostnames=None, local_ip=None):
     """Main function to update DNS rewrite rules for all hostnames"""
     logger.info("Starting DNS rewrite update...")
     
@@ -296,20 +429,27 @@ def update_dns_rewrite():
         return False
     
     # Parse hostnames
-    hostnames = parse_hostnames()
+    if hostnames is None:
+        hostnames = parse_hostnames()
     if not hostnames:
         logger.error("No hostnames configured")
         return False
     
-    logger.info(f"Processing {len(hostnames)} hostname(s): {hostnames}")
+    logger.info("Processing %s hostname(s): %s", len(hostnames), hostnames)
     
     # Get local IP
-    local_ip = get_ethernet_ip()
+    if local_ip is None:
+        local_ip = get_ethernet_ip()
     if not local_ip:
         logger.error("Could not determine local IP address")
         return False
     
-    logger.info(f"Local IP: {local_ip}")
+    logger.info("Local IP: %s", local_ip)
+    
+    # Skip the API entirely if nothing changed since the last successful run
+    if is_cache_current(hostnames, local_ip):
+        logger.info("DNS rewrites unchanged since last successful run, skipping update")
+        return True
     
     # Check existing rewrites
     existing_rewrites = get_existing_rewrites()
@@ -317,23 +457,32 @@ def update_dns_rewrite():
         logger.error("Could not retrieve existing rewrites")
         return False
     
-    # Process each hostname
+    # Index existing rules by domain for constant-time lookups (a domain may have several answers)
+    existing = {}
+    for rewrite in existing_rewrites:
+        existing.setdefault(rewrite.get('domain'), set()).add(rewrite.get('answer'))
+    
+    # Process hostnames concurrently; each worker borrows a connection from the shared session
     success_count = 0
     total_count = len(hostnames)
     
-    for hostname in hostnames:
-        if process_hostname(hostname, local_ip, existing_rewrites):
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, total_count)) as executor:
+        results = list(executor.map(lambda hostname: process_hostname(hostname, local_ip, existing), hostnames))
+    
+    for hostname, success in zip(hostnames, results):
+        if success:
             success_count += 1
         else:
-            logger.error(f"Failed to process hostname: {hostname}")
+            logger.error("Failed to process hostname: %s", hostname)
             # Continue processing other hostnames instead of failing completely
     
     # Log summary
     if success_count == total_count:
-        logger.info(f"DNS rewrite update completed successfully for all {total_count} hostname(s)")
+        logger.info("DNS rewrite update completed successfully for all %s hostname(s)", total_count)
+        write_cache(hostnames, local_ip)
         return True
     elif success_count > 0:
-        logger.warning(f"DNS rewrite update partially completed: {success_count}/{total_count} hostname(s) succeeded")
+        logger.warning("DNS rewrite update partially completed: %s/%s hostname(s) succeeded", success_count, total_count)
         return True  # Return success if at least one hostname was processed
     else:
         logger.error("DNS rewrite update failed for all hostnames")
@@ -341,8 +490,9 @@ def update_dns_rewrite():
 
 def main():
     """Main entry point"""
+    hostnames = parse_hostnames()
+    
     if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
-        hostnames = parse_hostnames()
         hostname_display = ', '.join(hostnames) if hostnames else '[not configured]'
         
         print(f"""
@@ -371,24 +521,26 @@ Options:
         """)
         return
     
+    # Only resolve the local IP once we know it is needed
+    local_ip = get_ethernet_ip() if hostnames else None
+    
     if len(sys.argv) > 1 and sys.argv[1] == '--dry-run':
         logger.info("DRY RUN MODE - No changes will be made")
-        hostnames = parse_hostnames()
-        local_ip = get_ethernet_ip()
         if local_ip and hostnames:
-            logger.info(f"Would update {len(hostnames)} hostname(s): {hostnames}")
+            logger.info("Would update %s hostname(s): %s", len(hostnames), hostnames)
             for hostname in hostnames:
                 if validate_hostname(hostname):
-                    logger.info(f"  {hostname} -> {local_ip}")
+                    logger.info("  %s -> %s", hostname, local_ip)
                 else:
-                    logger.error(f"  Invalid hostname format: {hostname}")
+                    logger.error("  Invalid hostname format: %s", hostname)
         elif not hostnames:
             logger.error("No hostnames configured")
         else:
             logger.error("Could not determine local IP")
         return
     
-    success = update_dns_rewrite()
+    # Reuse the values resolved above rather than recomputing them
+    success = update_dns_rewrite(hostnames, local_ip)
     sys.exit(0 if success else 1)
 
 if __name__ == "__main__":